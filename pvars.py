@@ -1,19 +1,81 @@
-
 import pathlib
-import shutil
 import inspect
+import linecache
+import functools
+import contextlib
+import threading
+import time
 import typing
 import atexit
 import signal
 import pickle
+import pickletools
 import json
 import enum
 import csv
 import os
+import sys
+import io
+import mmap
 import re
+import errno
+import hashlib
+
+try:
+    import liburing
+except ImportError:
+    liburing = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+_contexts = {}
+_module_paths = {}
+_sigint_installed = False
+_RE_LAMBDA = re.compile(r"([^. ]+)\)")
+_RE_LONG_DIGITS = re.compile(rb"\d{19}")
+_WRITE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_CLOEXEC", 0) | getattr(os, "O_BINARY", 0)
+
+
+def _write_all(fd, data) -> None:
+    view, offset = memoryview(data), 0
+    while offset < len(view): offset += os.pwrite(fd, view[offset:], offset)
 
 
-_contexts = []
+def _digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _json_loads(raw: bytes):
+    # orjson rejects NaN/Infinity and reads integers outside 64 bits as floats, so anything with a
+    # 19+ digit run (which may be past int64) goes to the stdlib
+    if orjson is not None and not _RE_LONG_DIGITS.search(raw):
+        with contextlib.suppress(orjson.JSONDecodeError): return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _source_var_name(code) -> str:
+    # drop stale source (e.g. after importlib.reload) and key the cache on the file's mtime as well
+    linecache.checkcache(code.co_filename)
+    try: mtime = os.stat(code.co_filename).st_mtime_ns
+    except OSError: mtime = None
+    return _extract_var_name(code.co_filename, code.co_firstlineno, mtime)
+
+
+@functools.lru_cache(maxsize=None)
+def _extract_var_name(filename: str, firstlineno: int, mtime: typing.Optional[int]) -> str:
+    # keyed on the definition site so source is only parsed once, without keeping code objects alive
+    lines = linecache.getlines(filename)
+    if not 0 < firstlineno <= len(lines): raise OSError("could not get source code")
+    source = "".join(inspect.getblock(lines[firstlineno - 1:]))
+    if "def" in source: raise Exception("Non lambda functions are unsupported for now")
+    elif "lambda" in source: match = _RE_LAMBDA.search(source)
+    else: raise TypeError("Improper function passed")
+    if not match: raise TypeError("Improper function passed")
+    return match.group(1)
 
 
 class Format(enum.Enum):
@@ -22,12 +84,90 @@ class Format(enum.Enum):
     CSV = enum.auto()
 
 
+class UringWriter:
+    """Batches the write, fsync and rename of several syncs into one io_uring submission (requires liburing)"""
+
+    # a lone pwrite beats ring setup and submission for payloads this small
+    SMALL_SIZE = 4 * 1024
+
+    def __init__(self, depth: int = 32):
+        if liburing is None: raise RuntimeError("liburing is not installed")
+        self.depth = depth
+        self.ring = None
+        self._refused = False
+        self._cqe = liburing.Cqe()
+        self._pending = []
+
+    def ready(self) -> bool:
+        # the ring is only set up once a payload actually needs it; io_uring may still be refused at runtime
+        # (seccomp, kernel.io_uring_disabled), in which case callers write on their own
+        if self.ring is None and not self._refused:
+            ring = liburing.Ring()
+            try:
+                liburing.io_uring_queue_init(self.depth, ring)
+                self.ring = ring
+            except OSError:
+                self._refused = True
+        return self.ring is not None
+
+    def write(self, data: bytes, tempname: str, filename: str) -> None:
+        # every commit takes three linked entries, submit early rather than overflow the ring
+        if (len(self._pending) + 1) * 3 > self.depth: self.submit_and_wait()
+        fd = os.open(tempname, _WRITE_FLAGS, 0o666)
+        index = len(self._pending)
+        self._pending.append((fd, data, tempname))
+        sqe = liburing.io_uring_get_sqe(self.ring)
+        liburing.io_uring_prep_write(sqe, fd, data, 0)
+        liburing.io_uring_sqe_set_flags(sqe, liburing.IOSQE_IO_LINK)
+        liburing.io_uring_sqe_set_data64(sqe, index * 3)
+        sqe = liburing.io_uring_get_sqe(self.ring)
+        liburing.io_uring_prep_fsync(sqe, fd)
+        liburing.io_uring_sqe_set_flags(sqe, liburing.IOSQE_IO_LINK)
+        liburing.io_uring_sqe_set_data64(sqe, index * 3 + 1)
+        sqe = liburing.io_uring_get_sqe(self.ring)
+        liburing.io_uring_prep_rename(sqe, tempname, filename)    # atomic commit
+        liburing.io_uring_sqe_set_data64(sqe, index * 3 + 2)
+
+    def submit_and_wait(self) -> None:
+        if not self._pending: return
+        pending, self._pending = self._pending, []
+        error = None
+        try:
+            liburing.io_uring_submit_and_wait(self.ring, len(pending) * 3)
+            for _ in range(len(pending) * 3):
+                liburing.io_uring_wait_cqe(self.ring, self._cqe)
+                cqe = self._cqe[0]
+                res, data = cqe.res, liburing.io_uring_cqe_get_data64(cqe)
+                liburing.io_uring_cqe_seen(self.ring, cqe)
+                index, op = divmod(data, 3)
+                if res < 0: error = error or OSError(-res, os.strerror(-res), pending[index][2])
+                elif op == 0 and res != len(pending[index][1]): error = error or OSError(errno.EIO, "Short write", pending[index][2])
+        finally:
+            for fd, _, tempname in pending:
+                os.close(fd)
+                if os.access(tempname, os.F_OK): os.remove(tempname)
+        if error: raise error
+
+    def close(self) -> None:
+        if self.ring is not None: liburing.io_uring_queue_exit(self.ring)
+        self.ring = None
+
+
 class PersistentDict(dict):
 
-    def __init__(self, filename, fileformat=Format.PICKLE, dump_args=None):
+    def __init__(self, filename, fileformat=Format.PICKLE, dump_args=None, protocol=pickle.HIGHEST_PROTOCOL, buffer_callback=None, buffers=None, optimize=False, direct_io=False):
         if dump_args is None: self.dump_args = {}
         else: self.dump_args = dump_args
         self.file_format = fileformat
+        # load() recognises pickles by their PROTO opcode, which protocols 0 and 1 don't write
+        if protocol < 2: raise ValueError("Pickle protocol 2 or higher is required")
+        self.protocol = protocol
+        self.buffer_callback = buffer_callback
+        self.buffers = buffers
+        self.optimize = optimize
+        self.direct_io = direct_io
+        self._digest = None
+        self._sync_lock = threading.RLock()
         self.file_name = filename
         if os.access(filename, os.F_OK):
             try: self.load(filename)
@@ -35,18 +175,43 @@ class PersistentDict(dict):
         else: raise Exception("File not available")
         dict.__init__(self)
 
-    def sync(self):
+    def sync(self, writer: typing.Optional[UringWriter] = None):
+        # every sync shares one temp file, so they must not overlap (e.g. with a context's writer thread)
+        with self._sync_lock:
+            return self._sync(writer)
+
+    def _sync(self, writer: typing.Optional[UringWriter]):
         filename = self.file_name
         tempname = filename + ".tmp"
+        data = self.dumps()
+        # nothing changed since the file was last read or written, skip the whole write path
+        digest = _digest(data)
+        if digest == self._digest: return
+        flags = _WRITE_FLAGS
+        direct = self.direct_io and hasattr(os, "O_DIRECT")
+        if writer is not None and not direct and len(data) >= UringWriter.SMALL_SIZE and writer.ready():
+            self._digest = None    # committed later by the writer
+            return writer.write(data, tempname, filename)
+        if direct: flags |= os.O_DIRECT
         try:
-            with open(tempname, 'wb' if self.file_format is Format.PICKLE else 'w', newline='' if self.file_format is Format.CSV else None) as fileobj:
-                self.dump(fileobj)
+            fd = os.open(tempname, flags, 0o666)
+            try:
+                if direct:
+                    # O_DIRECT needs a page aligned buffer padded to a block multiple, trimmed afterwards
+                    with mmap.mmap(-1, -(-len(data) // mmap.PAGESIZE) * mmap.PAGESIZE or mmap.PAGESIZE) as buf:
+                        buf.write(data)
+                        _write_all(fd, buf)
+                    os.ftruncate(fd, len(data))
+                else:
+                    _write_all(fd, data)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
         except Exception:
-            os.remove(tempname)
+            if os.access(tempname, os.F_OK): os.remove(tempname)
             raise
-        finally:
-            fileobj.close()
-        shutil.move(tempname, self.file_name)    # atomic commit
+        os.replace(tempname, self.file_name)    # atomic commit
+        self._digest = digest
 
     def __enter__(self):
         return self
@@ -56,25 +221,46 @@ class PersistentDict(dict):
         self.sync()
 
     def dump(self, fileobj):
+        data = self.dumps()
+        # JSON and CSV can still be dumped into a text mode file
+        if isinstance(fileobj, io.TextIOBase): data = data.decode()
+        fileobj.write(data)
+
+    def dumps(self) -> bytes:
         if self.file_format == Format.CSV:
-            csv.writer(fileobj).writerows(self.items(), **self.dump_args)
+            text = io.StringIO(newline='')
+            csv.writer(text).writerows(self.items(), **self.dump_args)
+            return text.getvalue().encode()
         elif self.file_format == Format.JSON:
-            json.dump(dict(self), fileobj, **self.dump_args)
+            return json.dumps(self, **self.dump_args).encode()
         elif self.file_format == Format.PICKLE:
-            pickle.dump(dict(self), fileobj, 5, **self.dump_args)
+            # dict(self) is a single C level copy, atomic with respect to the writer thread, and pickles
+            # as a plain dict without routing every value through a Python level dispatch table
+            data = pickle.dumps(dict(self), self.protocol, buffer_callback=self.buffer_callback, **self.dump_args)
+            if self.optimize: data = pickletools.optimize(data)
+            return data
         else:
             raise NotImplementedError("Unknown format: " + repr(self.file_format.name))
 
     def load(self, filename):
-        # try formats from most restrictive to least restrictive
-        for loader in (pickle.load, json.load, csv.reader):
-            for mode in ("r", "rb"):
-                try:
-                    with open(filename, mode) as fileobj:
-                        return self.update(loader(fileobj))
-                except Exception:
-                    pass
-        raise ValueError("File not in a supported format")
+        # read the file once and parse from memory, dispatching on the leading bytes
+        with open(filename, "rb") as fileobj:
+            raw = fileobj.read()
+        head = raw[:16]
+        data = None
+        if head.startswith(b"\x80"):
+            data = pickle.loads(raw, buffers=self.buffers)
+        elif head.lstrip()[:1] in (b"{", b"["):
+            # a CSV db whose first key starts with a bracket looks the same, so fall through to CSV if this isn't JSON
+            with contextlib.suppress(ValueError, TypeError):
+                decoded = _json_loads(raw)
+                data = decoded if isinstance(decoded, dict) else dict(decoded)
+        if data is None:
+            if b"\x00" in head: raise ValueError("File not in a supported format")
+            dict.update(self, csv.reader(io.StringIO(raw.decode(), newline='')))
+        self._digest = _digest(raw)
+        # merging a whole dict into the empty table sizes it once up front instead of growing per key
+        if data is not None: dict.update(self, data)
 
 
 class Idict(dict):
@@ -84,8 +270,9 @@ class Idict(dict):
         super().__init__(elems)
 
     def __setitem__(self, key, value):
-        super().__setitem__(key, value)
-        self._parent.save()
+        # the writer thread may be serializing this dict, so mutate under the context lock
+        with self._parent._lock: super().__setitem__(key, value)
+        self._parent._enqueue_dirty()
 
     def save(self):
         self._parent.save()
@@ -105,40 +292,90 @@ class ModuleContext:
 
     def __init__(self, path: str):
         self.auto_save = True
+        self.save_delay = 0.01
         self.path = path
         self.db = PersistentDict(path, Format.PICKLE)
         self.pvar_index = {}
+        self._dirty = False
+        self._buffering = 0
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self._writer_thread = None
+        self._error = None
 
     def make_dict(self, default: dict, name: str):
         if name in self.db: i_dict = Idict(self, self.db[name])
         else: i_dict = Idict(self, default)
         p_var = PVar(name, lambda: i_dict)
-        self.pvar_index[p_var.name] = p_var
+        with self._lock: self.pvar_index[p_var.name] = p_var
         return i_dict
 
     def make_var(self, default, callback: typing.Callable):
-        code = inspect.getsource(callback)
-        # match = re.search(r"return\s*(\w+)\s*$", code)
-        if "def" in code: raise Exception("Non lambda functions are unsupported for now")
-        elif "lambda" in code: match = re.search(r"([^. ]+)\)", code)
-        else: raise TypeError("Improper function passed")
-        if not match: raise TypeError("Improper function passed")
-        var_name = match.group(1)
+        code = callback.__code__
+        if code.co_name != "<lambda>": raise Exception("Non lambda functions are unsupported for now")
+        names = code.co_freevars + code.co_cellvars + code.co_names
+        # a lambda loading a single name carries it in the bytecode, anything else (e.g. attributes) needs the source
+        var_name = names[0] if len(names) == 1 else _source_var_name(code)
         p_var = PVar(var_name, callback)
-        self.pvar_index[p_var.name] = p_var
+        with self._lock: self.pvar_index[p_var.name] = p_var
         if p_var.name not in self.db: return default
         else: return self.db[p_var.name]
 
     def reset(self) -> None:
-        for var in self.db: del self.db[var]
-        self.db.sync()
+        with self._lock:
+            self.db.clear()
+            self.db.sync()
 
     def all(self) -> PersistentDict:
         return self.db
 
-    def save(self) -> None:
-        for name, pvar in self.pvar_index.items(): self.db[name] = pvar.value()
-        self.db.sync()
+    def save(self, writer: typing.Optional[UringWriter] = None) -> None:
+        with self._lock:
+            self._raise_pending_error()
+            if self._buffering:
+                self._dirty = True
+                return
+            for name, pvar in self.pvar_index.items(): self.db[name] = pvar.value()
+            self.db.sync(writer)
+            self._dirty = False
+
+    @contextlib.contextmanager
+    def buffered(self):
+        with self._lock: self._buffering += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._buffering -= 1
+                flush = not self._buffering and self._dirty
+            if flush: self.save()
+
+    def _enqueue_dirty(self) -> None:
+        # idict writes only flag the context, the writer thread coalesces them into one save
+        with self._lock:
+            self._dirty = True
+            if self._buffering: return
+            if self._writer_thread is None:
+                self._writer_thread = threading.Thread(target=self._write_behind, name=f"pvars writer {self.path}", daemon=True)
+                self._writer_thread.start()
+        self._wake.set()
+
+    def _write_behind(self) -> None:
+        while True:
+            self._wake.wait()
+            time.sleep(self.save_delay)
+            self._wake.clear()
+            with self._lock:
+                if not self._dirty or self._buffering: continue
+                # a failed save stays dirty and is retried on the next wake; until then an explicit save() raises it
+                self._error = None
+                try: self.save()
+                except Exception as error: self._error = error
+
+    def _raise_pending_error(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
 
     def configure(self, *, auto_save: bool = False, file_format: Format = False, **dump_args) -> None:
         self.auto_save = auto_save
@@ -150,38 +387,66 @@ def get_context(*, extra_path: typing.Union[str, os.PathLike] = "", abs_path: ty
 
     if abs_path:
         db_path = abs_path
-        db_dir = pathlib.Path(db_path).parent
+        if not pathlib.Path(db_path).parent.parent.exists():
+            raise Exception(f"{db_path} is not valid")
     else:
-        frame = inspect.stack()[1]
-        module = inspect.getmodule(frame[0])
-        module_path = pathlib.Path(module.__file__)
-        db_dir = pathlib.Path(module.__file__).parent / os.fspath(extra_path)
-        db_dir.mkdir(parents=True, exist_ok=True)
-        db_path = (db_dir / (module_path.stem + ".pydb")).resolve().__str__()
-
-    global _contexts
-    if not db_dir.parent.exists():
-        raise Exception(f"{db_path} is not valid")
-    for ctx in _contexts:
-        if db_path == ctx.path: return ctx
-    else:
-        ctx = ModuleContext(db_path)
-        ctx.configure(**config_params)
-        _contexts.append(ctx)
-        return ctx
+        frame = sys._getframe(1)
+        key = (frame.f_code.co_filename, os.fspath(extra_path))
+        db_path = _module_paths.get(key)
+        if db_path is None:
+            module = inspect.getmodule(frame)
+            module_path = pathlib.Path(module.__file__)
+            db_dir = module_path.parent / os.fspath(extra_path)
+            db_dir.mkdir(parents=True, exist_ok=True)
+            db_path = (db_dir / (module_path.stem + ".pydb")).resolve().__str__()
+            _module_paths[key] = db_path
+
+    ctx = _contexts.get(db_path)
+    if ctx: return ctx
+    ctx = ModuleContext(db_path)
+    ctx.configure(**config_params)
+    _contexts[db_path] = ctx
+    return ctx
 
 
 def _clean_up():
-    for context in _contexts:
-        try:
-            if context.auto_save:
-                context.save()
-        except Exception:
-            raise RuntimeError(f"Failed saving to {context.path}")
+    # with liburing available, several contexts are committed in one batched submission
+    writer = None
+    if liburing is not None and sum(context.auto_save or context._dirty for context in _contexts.values()) >= 2: writer = UringWriter()
+    # hold every context until the batch is committed, so writer threads can't reuse a queued temp file
+    with contextlib.ExitStack() as held:
+        if writer is not None: held.callback(writer.close)
+        for context in _contexts.values():
+            held.enter_context(context._lock)
+            held.enter_context(context.db._sync_lock)
+            # pending idict writes are flushed even without auto_save, retrying any failed background save
+            context._error = None
+            try:
+                if context.auto_save or context._dirty:
+                    context.save(writer)
+            except Exception:
+                raise RuntimeError(f"Failed saving to {context.path}")
+        if writer is not None:
+            try: writer.submit_and_wait()
+            except Exception as error:
+                raise RuntimeError(f"Failed saving to {error.filename}")
+
+
+def _exit_on_sigint(signum, frame):
+    sys.exit(130)    # unwinds through atexit, so _clean_up still runs
+
+
+def _install_sigint_handler():
+    # leave handlers installed by the user alone, and only touch signals from the main thread
+    global _sigint_installed
+    if _sigint_installed or threading.current_thread() is not threading.main_thread(): return
+    if signal.getsignal(signal.SIGINT) in (signal.SIG_DFL, signal.default_int_handler):
+        signal.signal(signal.SIGINT, _exit_on_sigint)
+    _sigint_installed = True
 
 
 atexit.register(_clean_up)
-signal.signal(signal.SIGINT, lambda x, y: exit())
+_install_sigint_handler()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,156 @@
+import os
+import pickle
+import tempfile
+import time
+import unittest
+
+import pvars
+
+
+class TempDBTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._dir.name, "test.pydb")
+        open(self.path, "wb").close()
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+
+class TestRoundTrip(TempDBTestCase):
+
+    def round_trip(self, data, **kwargs):
+        db = pvars.PersistentDict(self.path, **kwargs)
+        db.update(data)
+        db.sync()
+        return dict(pvars.PersistentDict(self.path))
+
+    def test_pickle_every_protocol(self):
+        data = {"a": 1, "b": [1, 2.5, None], "c": {"nested": (1, 2)}, 3: b"bytes"}
+        for protocol in range(2, pickle.HIGHEST_PROTOCOL + 1):
+            with self.subTest(protocol=protocol):
+                self.assertEqual(self.round_trip(data, protocol=protocol), data)
+
+    def test_pickle_protocol_below_2_rejected(self):
+        for protocol in (0, 1):
+            with self.subTest(protocol=protocol), self.assertRaises(ValueError):
+                pvars.PersistentDict(self.path, protocol=protocol)
+
+    def test_json(self):
+        data = {"a": 1, "b": [1, 2.5, None, True], "c": {"nested": "x"}, "big": -2 ** 63 - 1, "nan": float("inf")}
+        self.assertEqual(self.round_trip(data, fileformat=pvars.Format.JSON), data)
+
+    def test_csv(self):
+        data = {"a": "1", "b": "x,y", "c": 'quote"d'}
+        self.assertEqual(self.round_trip(data, fileformat=pvars.Format.CSV), data)
+
+    def test_bracket_led_csv(self):
+        data = {"[tag]": "1", "other": "2"}
+        self.assertEqual(self.round_trip(data, fileformat=pvars.Format.CSV), data)
+        with open(self.path, "wb") as fileobj: fileobj.write(b"[1,2]\r\n{x},3\r\n")
+        self.assertEqual(dict(pvars.PersistentDict(self.path)), {"[1": "2]", "{x}": "3"})
+
+    def test_empty_file(self):
+        self.assertEqual(dict(pvars.PersistentDict(self.path)), {})
+
+    def test_unchanged_sync_skips_write(self):
+        self.round_trip({"a": 1})
+        mtime = os.stat(self.path).st_mtime_ns
+        time.sleep(0.01)
+        pvars.PersistentDict(self.path).sync()
+        self.assertEqual(os.stat(self.path).st_mtime_ns, mtime)
+
+
+class TestIdictSaving(TempDBTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.ctx = pvars.ModuleContext(self.path)
+        self.ctx.configure(auto_save=False, file_format=pvars.Format.JSON)
+        self.syncs = 0
+        sync = self.ctx.db.sync
+
+        def counting_sync(*args):
+            self.syncs += 1
+            return sync(*args)
+        self.ctx.db.sync = counting_sync
+
+    def wait_for_writer(self):
+        deadline = time.time() + 2
+        while self.ctx._dirty and time.time() < deadline: time.sleep(0.01)
+        self.assertFalse(self.ctx._dirty)
+
+    def test_burst_is_coalesced(self):
+        idict = self.ctx.make_dict({}, "D")
+        for i in range(200): idict[str(i)] = i
+        self.wait_for_writer()
+        self.assertLess(self.syncs, 10)
+        self.assertEqual(dict(pvars.PersistentDict(self.path))["D"], {str(i): i for i in range(200)})
+
+    def test_buffered_saves_once(self):
+        idict = self.ctx.make_dict({}, "D")
+        with self.ctx.buffered():
+            for i in range(50): idict[str(i)] = i
+            self.assertEqual(self.syncs, 0)
+        self.assertEqual(self.syncs, 1)
+        self.assertEqual(dict(pvars.PersistentDict(self.path))["D"], {str(i): i for i in range(50)})
+
+    def test_failed_background_save_is_retried(self):
+        idict = self.ctx.make_dict({}, "D")
+        sync = self.ctx.db.sync
+        failures = [OSError("disk full")]
+
+        def flaky_sync(*args):
+            if failures: raise failures.pop()
+            return sync(*args)
+        self.ctx.db.sync = flaky_sync
+        idict["a"] = 1
+        deadline = time.time() + 2
+        while self.ctx._error is None and time.time() < deadline: time.sleep(0.01)
+        idict["b"] = 2
+        self.wait_for_writer()
+        self.assertEqual(dict(pvars.PersistentDict(self.path))["D"], {"a": 1, "b": 2})
+
+
+class TestCleanUp(TempDBTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self._contexts = pvars._contexts
+        pvars._contexts = {}
+        self.paths = []
+        for name in ("one", "two"):
+            path = os.path.join(self._dir.name, name + ".pydb")
+            open(path, "wb").close()
+            ctx = pvars.get_context(abs_path=path, auto_save=True, file_format=pvars.Format.JSON)
+            ctx.db["small"] = name
+            ctx.db["large"] = name * 4096
+            self.paths.append(path)
+
+    def tearDown(self):
+        pvars._contexts = self._contexts
+        super().tearDown()
+
+    def assert_saved(self):
+        for path, name in zip(self.paths, ("one", "two")):
+            self.assertEqual(dict(pvars.PersistentDict(path)), {"small": name, "large": name * 4096})
+            self.assertFalse(os.path.exists(path + ".tmp"))
+
+    def test_saves_every_context(self):
+        pvars._clean_up()
+        self.assert_saved()
+
+    @unittest.skipIf(pvars.liburing is None, "liburing is not installed")
+    def test_refused_io_uring_falls_back(self):
+        queue_init = pvars.liburing.io_uring_queue_init
+
+        def refuse(*args): raise PermissionError("io_uring disabled")
+        pvars.liburing.io_uring_queue_init = refuse
+        try: pvars._clean_up()
+        finally: pvars.liburing.io_uring_queue_init = queue_init
+        self.assert_saved()
+
+
+if __name__ == "__main__":
+    unittest.main()